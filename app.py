@@ -4,47 +4,426 @@ Pour PDF scannes et documents complexes
 Utilise des modeles ML pour OCR + detection de structure
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
+from flask.json.provider import JSONProvider
+import hashlib
+import json
+import orjson
+import re
 import tempfile
 import os
+import shutil
+import threading
 import time
-import requests
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import ExitStack, contextmanager, nullcontext
+import multiprocessing
+from types import SimpleNamespace
+import httpx
 from urllib.parse import urlparse
 
 # Configuration pour CPU (VPS sans GPU)
 # Forcer l'utilisation du CPU
 os.environ["TORCH_DEVICE"] = "cpu"
-# Utiliser ocrmypdf (plus rapide que surya sur CPU)
-os.environ["OCR_ENGINE"] = "ocrmypdf"
+# Reconnaissance surya compilee avec cache KV statique (plus rapide et moins
+# gourmande en memoire), compilation payee au chargement via le warm-up
+os.environ.setdefault("COMPILE_RECOGNITION", "true")
+
+
+class OrjsonProvider(JSONProvider):
+    """
+    Serialisation JSON de Flask (jsonify) via orjson.
+    L'ordre des champs est conserve ("success" et "markdown" en tete).
+    """
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype="application/json")
+
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # Limite de taille fichier (defaut 50MB)
 MAX_FILE_SIZE = int(os.getenv("MAX_FILE_SIZE_MB", "50")) * 1024 * 1024
 
+# Chargement des modeles a l'import du module (avant le fork des workers gunicorn)
+PRELOAD_MODELS = os.getenv("PRELOAD_MODELS", "true").lower() == "true"
+
+# python app.py lance gunicorn (gthread) au lieu du serveur de developpement Flask
+FLASK_PROD = os.getenv("FLASK_PROD", "1") == "1"
+
+# Compilation des modeles avec torch.compile (warm-up ~60-80s au chargement)
+TORCH_COMPILE = os.getenv("MARKER_TORCH_COMPILE", "0") == "1"
+COMPILE_RECOGNITION = os.environ["COMPILE_RECOGNITION"].lower() in ("1", "true")
+
+# Inference en BF16 (autocast) si le CPU le supporte (AVX-512 BF16 / AMX)
+BF16 = os.getenv("MARKER_BF16", "0") == "1"
+
+# Quantification dynamique int8 des couches Linear (exclusif avec BF16)
+INT8 = os.getenv("MARKER_INT8", "0") == "1"
+if INT8 and BF16:
+    print("MARKER_INT8 et MARKER_BF16 sont exclusifs, BF16 desactive")
+    BF16 = False
+
+# Pages de 2MB (transparent hugepages) pour les poids des modeles
+HUGEPAGES = os.getenv("MARKER_HUGEPAGES", "0") == "1"
+
+# Conversion des pages en parallele dans des processus forkes (modeles partages
+# en copy-on-write): "0" desactive, "auto" = coeurs / PAGE_WORKER_THREADS, ou un nombre
+PAGE_WORKER_THREADS = int(os.getenv("MARKER_PAGE_WORKER_THREADS", "4"))
+_page_parallelism = os.getenv("MARKER_PAGE_PARALLELISM", "0").lower()
+if _page_parallelism == "auto":
+    PAGE_PARALLELISM = max(1, (os.cpu_count() or 1) // PAGE_WORKER_THREADS)
+else:
+    PAGE_PARALLELISM = int(_page_parallelism)
+
+# Nombre de conversions Marker executees en parallele (modeles partages, CPU-bound)
+MARKER_CONCURRENCY = int(os.getenv("MARKER_CONCURRENCY", "1"))
+# Nombre de conversions en attente au-dela duquel on repond 503
+MARKER_MAX_PENDING = int(os.getenv("MARKER_MAX_PENDING", "4"))
+# Timeout d'une conversion en secondes
+CONVERT_TIMEOUT = int(os.getenv("CONVERT_TIMEOUT", "600"))
+
+_executor = ThreadPoolExecutor(max_workers=MARKER_CONCURRENCY, thread_name_prefix="marker")
+_slots = threading.BoundedSemaphore(MARKER_CONCURRENCY + MARKER_MAX_PENDING)
+
+# Traitements en cours, par cle (contenu du PDF ou URL): les requetes
+# identiques concurrentes attendent le resultat du premier traitement
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+# Pool de processus pour les pages, cree au premier usage dans le processus
+# qui sert les requetes (apres le fork des workers gunicorn)
+_page_pool = None
+_page_pool_pid = None
+_page_pool_lock = threading.Lock()
+
+
+def _default_tmp_dir():
+    """
+    Retourne /dev/shm (tmpfs) s'il a la place pour les PDF des conversions en
+    cours et en attente, sinon None (repertoire temporaire systeme).
+    Le /dev/shm de Docker ne fait que 64MB par defaut.
+    """
+    if not os.access("/dev/shm", os.W_OK):
+        return None
+    try:
+        stats = os.statvfs("/dev/shm")
+    except OSError:
+        return None
+
+    # Marge x2 pour les uploads recus avant la mise en file, plus une copie
+    # par PDF pour ses extraits de pages si la conversion par pages est active
+    copies = (MARKER_CONCURRENCY + MARKER_MAX_PENDING) * (3 if PAGE_PARALLELISM > 1 else 2)
+    if stats.f_bavail * stats.f_frsize < MAX_FILE_SIZE * copies:
+        return None
+    return "/dev/shm"
+
+
+# Repertoire des PDF temporaires: tmpfs si assez grand, pour que Marker lise
+# le PDF par son chemin sans I/O disque
+PDF_TMP_DIR = os.getenv("PDF_TMP_DIR") or _default_tmp_dir()
+
+# Taille des blocs pour la copie des PDF vers le disque (1MB)
+CHUNK_SIZE = 1024 * 1024
+
+# Taille des tranches de markdown serialisees par la reponse en streaming (64KB)
+STREAM_SLICE_SIZE = 64 * 1024
+
+# Titres markdown de niveau 1 a 3 en debut de ligne
+HEADER_PATTERN = re.compile(r"^(#{1,3}) ", re.MULTILINE)
+
+# Client HTTP partage (HTTP/2, connexions reutilisees) pour les telechargements
+_http = httpx.Client(
+    http2=True,
+    timeout=120,
+    follow_redirects=True,
+    limits=httpx.Limits(max_keepalive_connections=32)
+)
+
+# Cache Redis des resultats (cle: SHA-256 du PDF), desactive si REDIS_URL absent
+REDIS_URL = os.getenv("REDIS_URL")
+REDIS_CACHE_TTL = int(os.getenv("REDIS_CACHE_TTL", "86400"))
+
+_cache = None
+if REDIS_URL:
+    import redis
+    _cache = redis.Redis.from_url(REDIS_URL, decode_responses=False)
+
 # Variables globales pour les modeles (charges une seule fois)
+# converter n'extrait pas les images (defaut), image_converter les extrait;
+# les deux partagent les memes modeles
 converter = None
+image_converter = None
 models_loaded = False
 models_loading = False
+bf16_enabled = False
+# Le verrou protege la transition de models_loading, l'evenement reveille
+# les requetes en attente a la fin du chargement (succes ou echec)
+_load_lock = threading.Lock()
+_load_done = threading.Event()
 
 
-def get_converter():
+def transform_models(model_dict, transform, label):
+    """
+    Applique une transformation a chaque modele PyTorch du dictionnaire.
+    Les predicteurs Surya exposent leur nn.Module via l'attribut 'model'.
+    """
+    import torch
+
+    for name, artifact in model_dict.items():
+        try:
+            if isinstance(artifact, torch.nn.Module):
+                model_dict[name] = transform(artifact)
+            elif isinstance(getattr(artifact, "model", None), torch.nn.Module):
+                artifact.model = transform(artifact.model)
+        except Exception as e:
+            print(f"{label} ignore pour '{name}': {e}")
+
+
+def compile_models(model_dict):
+    """Compile les modeles PyTorch du dictionnaire avec torch.compile."""
+    import torch
+
+    transform_models(
+        model_dict,
+        lambda m: torch.compile(m, mode="reduce-overhead", dynamic=True),
+        "torch.compile"
+    )
+
+
+def quantize_models(model_dict):
+    """Quantifie dynamiquement en int8 les couches Linear des modeles."""
+    import torch
+
+    transform_models(
+        model_dict,
+        lambda m: torch.ao.quantization.quantize_dynamic(m, {torch.nn.Linear}, dtype=torch.qint8),
+        "Quantification int8"
+    )
+
+
+def advise_hugepages(model_dict):
+    """
+    Demande au noyau des pages de 2MB (madvise MADV_HUGEPAGE) pour les
+    tenseurs de poids d'au moins 2MB, afin de limiter les TLB misses.
+    """
+    import ctypes
+    import mmap
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    libc.madvise.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int]
+    madv_hugepage = getattr(mmap, "MADV_HUGEPAGE", 14)
+    page_size = mmap.PAGESIZE
+    min_size = 2 * 1024 * 1024
+
+    def advise(module):
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            nbytes = tensor.numel() * tensor.element_size()
+            if nbytes < min_size:
+                continue
+            # madvise exige une adresse alignee sur une page
+            start = -(-tensor.data_ptr() // page_size) * page_size
+            end = tensor.data_ptr() + nbytes
+            if end > start:
+                libc.madvise(start, end - start, madv_hugepage)
+        return module
+
+    transform_models(model_dict, advise, "madvise")
+
+
+def configure_bf16():
+    """
+    Active l'autocast BF16 si le CPU le supporte, avec un seul pool de
+    threads intra-op (MKL/OpenMP) sur tous les coeurs.
+    """
+    global bf16_enabled
+    import torch
+
+    is_supported = getattr(torch.cpu, "is_bf16_supported", None) \
+        or getattr(torch.cpu, "_is_avx512_bf16_supported", None)
+    if is_supported is None or not is_supported():
+        print("BF16 non supporte par ce CPU, inference en FP32")
+        return
+
+    torch.set_num_threads(os.cpu_count())
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError as e:
+        # Impossible apres le demarrage d'un travail parallele
+        print(f"set_num_interop_threads ignore: {e}")
+    bf16_enabled = True
+    print("Inference en BF16 (autocast CPU)")
+
+
+def run_conversion(conv, path):
+    """Execute la conversion Marker, sous autocast BF16 si active."""
+    if bf16_enabled:
+        import torch
+        context = torch.autocast(device_type="cpu", dtype=torch.bfloat16)
+    else:
+        context = nullcontext()
+
+    with context:
+        return conv(path)
+
+
+def _init_page_worker():
+    """Limite les threads torch de chaque processus de pages."""
+    import torch
+    torch.set_num_threads(PAGE_WORKER_THREADS)
+
+
+def _convert_pages(path, include_images):
+    """Convertit un extrait du PDF dans un processus de pages (convertisseurs herites du fork)."""
+    rendered = run_conversion(image_converter if include_images else converter, path)
+    return rendered.markdown if hasattr(rendered, 'markdown') else str(rendered)
+
+
+def get_page_pool():
+    """
+    Retourne le pool de processus de pages du processus courant.
+    A la creation, les processus sont forkes immediatement (et non a la
+    premiere soumission) pour l'etre avant toute inference dans ce processus.
+    """
+    global _page_pool, _page_pool_pid
+
+    with _page_pool_lock:
+        if _page_pool is None or _page_pool_pid != os.getpid():
+            pool = ProcessPoolExecutor(
+                max_workers=PAGE_PARALLELISM,
+                mp_context=multiprocessing.get_context("fork"),
+                initializer=_init_page_worker
+            )
+            pool.submit(os.getpid).result()
+            _page_pool = pool
+            _page_pool_pid = os.getpid()
+        return _page_pool
+
+
+def reset_page_pool(pool):
+    """Abandonne un pool casse (processus tue, OOM...) pour qu'il soit recree."""
+    global _page_pool
+
+    with _page_pool_lock:
+        if _page_pool is pool:
+            _page_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def convert_document(conv, path, include_images=False):
+    """
+    Convertit un PDF, en repartissant ses pages en plages contigues sur
+    le pool de processus si MARKER_PAGE_PARALLELISM est active.
+    """
+    if PAGE_PARALLELISM <= 1:
+        return run_conversion(conv, path)
+
+    # Forker les processus de pages avant toute inference dans ce processus
+    pool = get_page_pool()
+
+    import pypdfium2
+
+    pdf = pypdfium2.PdfDocument(path)
+    try:
+        page_count = len(pdf)
+        shards = min(PAGE_PARALLELISM, page_count)
+        if shards <= 1:
+            return run_conversion(conv, path)
+
+        with ExitStack() as stack:
+            shard_paths = []
+            for i in range(shards):
+                pages = list(range(i * page_count // shards, (i + 1) * page_count // shards))
+                shard_path = stack.enter_context(temp_pdf())
+                shard = pypdfium2.PdfDocument.new()
+                shard.import_pages(pdf, pages)
+                shard.save(shard_path)
+                shard.close()
+                shard_paths.append(shard_path)
+
+            try:
+                page_markdowns = list(pool.map(_convert_pages, shard_paths, [include_images] * shards))
+            except BrokenProcessPool:
+                reset_page_pool(pool)
+                raise
+    finally:
+        pdf.close()
+
+    return SimpleNamespace(markdown="\n\n".join(page_markdowns))
+
+
+def warmup_converter(conv):
+    """
+    Convertit un PDF d'une page contenant une image de texte synthetique
+    (sans couche texte, donc passee a l'OCR) pour declencher la compilation
+    des modeles avant de servir les premieres requetes.
+    """
+    import pypdfium2
+    from PIL import Image, ImageDraw
+
+    try:
+        with temp_pdf() as tmp_path:
+            image = Image.new("RGB", (1024, 128), "white")
+            ImageDraw.Draw(image).text((16, 48), "Marker warm-up 0123456789", fill="black")
+
+            pdf = pypdfium2.PdfDocument.new()
+            page = pdf.new_page(612, 792)
+            pdf_image = pypdfium2.PdfImage.new(pdf)
+            pdf_image.set_bitmap(pypdfium2.PdfBitmap.from_pil(image))
+            pdf_image.set_matrix(pypdfium2.PdfMatrix().scale(512, 64).translate(50, 650))
+            page.insert_obj(pdf_image)
+            page.gen_content()
+            pdf.save(tmp_path)
+            pdf.close()
+            run_conversion(conv, tmp_path)
+    except Exception as e:
+        print(f"Warm-up ignore: {e}")
+
+
+def get_converter(include_images=False):
     """
     Charge le convertisseur Marker avec ses modeles.
-    Les modeles sont charges une seule fois au premier appel.
+    Les modeles sont charges une seule fois au premier appel, les appels
+    concurrents attendent la fin du chargement.
+
+    Args:
+        include_images: Convertisseur extrayant les images (plus lent)
     """
-    global converter, models_loaded, models_loading
+    global models_loading
 
     if models_loaded and converter is not None:
-        return converter
+        return image_converter if include_images else converter
+
+    with _load_lock:
+        start_loading = converter is None and not models_loading
+        if start_loading:
+            models_loading = True
+            _load_done.clear()
 
-    if models_loading:
+    if start_loading:
+        _load_models()
+    else:
         # Attendre que le chargement soit termine
-        while models_loading:
-            time.sleep(0.5)
-        return converter
+        _load_done.wait()
+
+    if converter is None:
+        raise RuntimeError("Echec du chargement des modeles Marker")
+    return image_converter if include_images else converter
+
+
+def _load_models():
+    """Charge les modeles Marker et signale la fin du chargement."""
+    global converter, image_converter, models_loaded, models_loading
 
-    models_loading = True
     try:
         print("Chargement des modeles Marker...")
         start_time = time.time()
@@ -52,44 +431,186 @@ def get_converter():
         from marker.converters.pdf import PdfConverter
         from marker.models import create_model_dict
 
+        if BF16:
+            configure_bf16()
+
         model_dict = create_model_dict()
-        converter = PdfConverter(artifact_dict=model_dict)
+        if INT8:
+            quantize_models(model_dict)
+        if HUGEPAGES:
+            advise_hugepages(model_dict)
+        if TORCH_COMPILE:
+            compile_models(model_dict)
+        # Sans extraction d'images, la reponse ne contenant que le markdown
+        conv = PdfConverter(artifact_dict=model_dict, config={"extract_images": False})
+        image_conv = PdfConverter(artifact_dict=model_dict)
+
+        if TORCH_COMPILE or COMPILE_RECOGNITION:
+            print("Warm-up torch.compile...")
+            warmup_converter(conv)
 
         elapsed = time.time() - start_time
         print(f"Modeles charges en {elapsed:.1f}s")
 
+        converter = conv
+        image_converter = image_conv
         models_loaded = True
-        return converter
 
     except Exception as e:
         print(f"Erreur chargement modeles: {e}")
-        models_loading = False
         raise
 
+    finally:
+        # Sous le verrou: un nouveau chargement ne peut pas faire clear()
+        # entre la fin de celui-ci et le reveil de ses requetes en attente
+        with _load_lock:
+            models_loading = False
+            _load_done.set()
+
+
+class ServerBusy(Exception):
+    """File d'attente des conversions pleine."""
+
+
+@contextmanager
+def temp_pdf():
+    """
+    Fournit le chemin d'un fichier PDF temporaire. Le fichier reste ouvert
+    pendant son utilisation et est supprime a sa fermeture.
+    """
+    with tempfile.NamedTemporaryFile(suffix='.pdf', dir=PDF_TMP_DIR) as tmp:
+        yield tmp.name
+
+
+def single_flight(key, fn):
+    """
+    Execute fn une seule fois pour les appels concurrents de meme cle.
 
-def download_pdf_from_url(url, timeout=120):
+    Returns:
+        tuple: (resultat de fn, True si cet appel a execute fn)
     """
-    Télécharge un PDF depuis une URL.
+    with _inflight_lock:
+        future = _inflight.get(key)
+        leader = future is None
+        if leader:
+            future = Future()
+            _inflight[key] = future
+
+    if leader:
+        try:
+            future.set_result(fn())
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with _inflight_lock:
+                _inflight.pop(key, None)
+
+    return future.result(), leader
+
+
+def cache_key(path, include_images=False):
+    """Calcule la cle (cache Redis et requetes en cours) a partir du contenu du PDF."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    prefix = b"marker:images:" if include_images else b"marker:text:"
+    return prefix + digest.digest()
+
+
+def cache_get(key):
+    """Retourne la reponse JSON en cache, ou None (cache absent ou indisponible)."""
+    if _cache is None:
+        return None
+    try:
+        return _cache.get(key)
+    except Exception as e:
+        print(f"Cache error: {e}")
+        return None
+
+
+def cache_set(key, body):
+    """Enregistre la reponse JSON en cache, sans faire echouer la requete."""
+    if _cache is None:
+        return
+    try:
+        _cache.setex(key, REDIS_CACHE_TTL, body)
+    except Exception as e:
+        print(f"Cache error: {e}")
+
+
+def download_pdf_from_url(url, dest, timeout=120):
+    """
+    Télécharge un PDF depuis une URL, par blocs, dans un fichier.
 
     Args:
         url: URL du PDF
+        dest: Fichier binaire ouvert en écriture
         timeout: Timeout en secondes (défaut: 120 pour gros PDFs)
 
     Returns:
-        bytes: Contenu du PDF
+        int: Taille du PDF en octets
     """
     parsed = urlparse(url)
     if parsed.scheme not in ('http', 'https'):
         raise ValueError(f"URL invalide: schéma '{parsed.scheme}' non supporté")
 
-    response = requests.get(url, timeout=timeout)
-    response.raise_for_status()
+    with _http.stream("GET", url, timeout=timeout) as response:
+        response.raise_for_status()
+
+        size = 0
+        for chunk in response.iter_bytes(CHUNK_SIZE):
+            size += len(chunk)
+            if size > MAX_FILE_SIZE:
+                raise ValueError(f"Fichier trop gros: plus de {MAX_FILE_SIZE / 1024 / 1024:.0f}MB")
+            dest.write(chunk)
+
+    return size
+
+
+def count_headers(markdown_text):
+    """
+    Compte les titres #, ## et ### en un seul parcours du markdown.
+
+    Returns:
+        list: [h1_count, h2_count, h3_count]
+    """
+    counts = [0, 0, 0]
+    for match in HEADER_PATTERN.finditer(markdown_text):
+        counts[len(match.group(1)) - 1] += 1
+    return counts
+
+
+def stream_json(markdown_text, metadata, key=None):
+    """
+    Genere la reponse JSON de /convert par morceaux, sans construire
+    la chaine serialisee complete en memoire.
+
+    Args:
+        markdown_text: Markdown converti
+        metadata: Champs suivant "markdown" dans la reponse
+        key: Cle de cache Redis, la reponse complete y est enregistree si fournie
+    """
+    parts = [] if key is not None else None
+
+    def emit(chunk):
+        if parts is not None:
+            parts.append(chunk)
+        return chunk
 
-    content = response.content
-    if len(content) > MAX_FILE_SIZE:
-        raise ValueError(f"Fichier trop gros: {len(content) / 1024 / 1024:.1f}MB (max {MAX_FILE_SIZE / 1024 / 1024:.0f}MB)")
+    yield emit(b'{"success":true,"markdown":"')
+    for start in range(0, len(markdown_text), STREAM_SLICE_SIZE):
+        text = markdown_text[start:start + STREAM_SLICE_SIZE]
+        try:
+            escaped = orjson.dumps(text)
+        except orjson.JSONEncodeError:
+            # Surrogates isoles refuses par orjson: echappes par json (\udXXX)
+            escaped = json.dumps(text).encode("ascii")
+        yield emit(escaped[1:-1])
+    yield emit(b'",' + orjson.dumps(metadata)[1:])
 
-    return content
+    if parts is not None:
+        cache_set(key, b"".join(parts))
 
 
 @app.route("/", methods=["GET"])
@@ -119,6 +640,78 @@ def health():
     })
 
 
+def process_pdf(path, include_images=False, key=None):
+    """
+    Convertit un PDF, ou retourne la reponse en cache pour ce contenu.
+
+    Args:
+        path: Chemin du PDF
+        include_images: Extraire les images (references dans le markdown)
+        key: Cle de cache deja calculee pour ce PDF
+
+    Returns:
+        tuple: (key, cached, markdown_text, metadata), cached etant la
+        reponse JSON en cache ou None
+    """
+    if key is None:
+        key = cache_key(path, include_images)
+
+    # Reponse deja calculee pour ce PDF
+    cached = cache_get(key)
+    if cached is not None:
+        return key, cached, None, None
+
+    start_time = time.time()
+
+    # Obtenir le convertisseur (charge les modeles si necessaire)
+    conv = get_converter(include_images)
+
+    # Conversion avec Marker (file d'attente bornee)
+    if not _slots.acquire(blocking=False):
+        raise ServerBusy()
+    future = _executor.submit(convert_document, conv, path, include_images)
+    future.add_done_callback(lambda _: _slots.release())
+    try:
+        rendered = future.result(timeout=CONVERT_TIMEOUT)
+    except FutureTimeoutError:
+        # Retirer la conversion de la file si elle n'a pas demarre
+        future.cancel()
+        raise
+
+    processing_time = time.time() - start_time
+
+    # Extraire le markdown
+    markdown_text = rendered.markdown if hasattr(rendered, 'markdown') else str(rendered)
+
+    # Compter les headers pour verifier la structure
+    h1_count, h2_count, h3_count = count_headers(markdown_text)
+    has_structure = (h1_count + h2_count + h3_count) > 0
+
+    # Nombre de pages
+    pages_count = len(rendered.pages) if hasattr(rendered, 'pages') else None
+
+    metadata = {
+        "source": "marker",
+        "has_structure": has_structure,
+        "pages_count": pages_count,
+        "processing_time_ms": int(processing_time * 1000),
+        "structure_stats": {
+            "h1_count": h1_count,
+            "h2_count": h2_count,
+            "h3_count": h3_count
+        }
+    }
+    return key, None, markdown_text, metadata
+
+
+def process_url(url, include_images=False):
+    """Telecharge un PDF depuis une URL puis le convertit (voir process_pdf)."""
+    with temp_pdf() as tmp_path:
+        with open(tmp_path, 'wb') as dest:
+            download_pdf_from_url(url, dest)
+        return process_pdf(tmp_path, include_images)
+
+
 @app.route("/convert", methods=["POST"])
 def convert():
     """
@@ -127,6 +720,11 @@ def convert():
     Accepte:
     - multipart/form-data avec fichier 'file'
     - JSON avec 'url' pour télécharger le PDF depuis une URL
+    - Paramètre de requête include_images=true pour extraire les images
+      (désactivé par défaut, plus rapide)
+
+    Les requêtes identiques simultanées (même contenu ou même URL) partagent
+    un seul téléchargement et une seule conversion.
 
     Retourne:
     - markdown: Texte au format Markdown avec structure (#, ##, ###)
@@ -135,19 +733,27 @@ def convert():
     - pages_count: Nombre de pages traitées
     """
     try:
-        pdf_content = None
+        include_images = request.args.get("include_images", "false").lower() == "true"
 
         # Option 1: Fichier uploadé
         if "file" in request.files:
             file = request.files["file"]
             if not file.filename:
                 return jsonify({"error": "Nom de fichier vide"}), 400
-            pdf_content = file.read()
+
+            # Sauvegarder temporairement (copie par blocs, sans charger le PDF en memoire)
+            with temp_pdf() as tmp_path:
+                with open(tmp_path, 'wb') as dest:
+                    shutil.copyfileobj(file.stream, dest, length=CHUNK_SIZE)
+                key = cache_key(tmp_path, include_images)
+                result, leader = single_flight(key, lambda: process_pdf(tmp_path, include_images, key))
 
         # Option 2: URL dans JSON
         elif request.is_json and "url" in request.json:
             url = request.json["url"]
-            pdf_content = download_pdf_from_url(url)
+            flight_key = b"url:images:" if include_images else b"url:text:"
+            flight_key += hashlib.sha256(url.encode("utf-8")).digest()
+            result, leader = single_flight(flight_key, lambda: process_url(url, include_images))
 
         else:
             return jsonify({
@@ -155,55 +761,26 @@ def convert():
                 "usage": "Envoyez un PDF via 'file' (multipart) ou via 'url' (JSON)"
             }), 400
 
-        # Sauvegarder temporairement
-        with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as tmp:
-            tmp.write(pdf_content)
-            tmp_path = tmp.name
-
-        try:
-            start_time = time.time()
-
-            # Obtenir le convertisseur (charge les modeles si necessaire)
-            conv = get_converter()
-
-            # Conversion avec Marker
-            rendered = conv(tmp_path)
+        key, cached, markdown_text, metadata = result
+        if cached is not None:
+            return app.response_class(cached, mimetype="application/json")
 
-            processing_time = time.time() - start_time
-
-            # Extraire le markdown
-            markdown_text = rendered.markdown if hasattr(rendered, 'markdown') else str(rendered)
-
-            # Compter les headers pour verifier la structure
-            h1_count = markdown_text.count('\n# ') + (1 if markdown_text.startswith('# ') else 0)
-            h2_count = markdown_text.count('\n## ')
-            h3_count = markdown_text.count('\n### ')
-            has_structure = (h1_count + h2_count + h3_count) > 0
-
-            # Nombre de pages
-            pages_count = len(rendered.pages) if hasattr(rendered, 'pages') else None
-
-            return jsonify({
-                "success": True,
-                "markdown": markdown_text,
-                "source": "marker",
-                "has_structure": has_structure,
-                "pages_count": pages_count,
-                "processing_time_ms": int(processing_time * 1000),
-                "structure_stats": {
-                    "h1_count": h1_count,
-                    "h2_count": h2_count,
-                    "h3_count": h3_count
-                }
-            })
-
-        finally:
-            # Nettoyer le fichier temporaire
-            if os.path.exists(tmp_path):
-                os.unlink(tmp_path)
+        # Seule la requete ayant fait la conversion alimente le cache
+        stream_key = key if leader and _cache is not None else None
+        return Response(stream_json(markdown_text, metadata, stream_key), mimetype="application/json")
 
     except ValueError as e:
         return jsonify({"success": False, "error": str(e)}), 400
+    except ServerBusy:
+        return jsonify({
+            "success": False,
+            "error": "Serveur occupe, reessayez plus tard"
+        }), 503
+    except FutureTimeoutError:
+        return jsonify({
+            "success": False,
+            "error": f"Conversion trop longue (> {CONVERT_TIMEOUT}s)"
+        }), 504
     except Exception as e:
         print(f"Convert error: {e}")
         return jsonify({
@@ -212,12 +789,33 @@ def convert():
         }), 500
 
 
-if __name__ == "__main__":
-    # Option: pre-charger les modeles au demarrage
-    preload = os.getenv("PRELOAD_MODELS", "false").lower() == "true"
-    if preload:
-        print("Pre-chargement des modeles...")
-        get_converter()
+# En lancement direct (python app.py) avec FLASK_PROD=1, le processus est remplace
+# par gunicorn, qui importe l'application et charge les modeles lui-meme
+exec_gunicorn = __name__ == "__main__" and FLASK_PROD
+
+# Pre-chargement des modeles a l'import: avec 'gunicorn --preload', les modeles
+# sont charges dans le master avant le fork et partages (copy-on-write) par les workers
+if PRELOAD_MODELS and not exec_gunicorn:
+    print("Pre-chargement des modeles...")
+    get_converter()
 
+
+if __name__ == "__main__":
     port = int(os.getenv("PORT", 5000))
-    app.run(host="0.0.0.0", port=port)
+    if exec_gunicorn:
+        # Un seul worker (une copie des modeles), plusieurs threads pour que les
+        # telechargements et uploads se poursuivent pendant les conversions
+        threads = os.getenv("GUNICORN_THREADS") or str(os.cpu_count() or 1)
+        os.execvp("gunicorn", [
+            "gunicorn",
+            "--workers", "1",
+            "--worker-class", "gthread",
+            "--threads", threads,
+            "--timeout", "600",
+            "--preload",
+            "--chdir", os.path.dirname(os.path.abspath(__file__)),
+            "--bind", f"0.0.0.0:{port}",
+            "app:app"
+        ])
+    else:
+        app.run(host="0.0.0.0", port=port, threaded=True)